@@ -12,21 +12,195 @@
 import numpy as np
 import sounddevice as sd
 import matplotlib.pyplot as plt
+from matplotlib.transforms import Affine2D
+import collections
+import collections.abc
 import datetime
+import functools
+import re
 from sys import platform
 import time
 import queue
+import warnings
+try:
+    import numba   # optional, speeds up the per block processing
+except ImportError:
+    numba = None
 
 # define sensitivity for attached sensors if using digital signal conditioner
 # Units are mV / engineering units ie 100mV / g
 # set to 0 to not apply sensitivity to get volts
 #
 # Digital Accelerometers like the 333D01 return g's.  That can be scale to m/s^2
-eu_sen = np.array([100.0, 100.0])
+eu_sen = np.array([100.0, 100.0], dtype=np.float32)
 eu_units = ["g", "g"]
 blocksize = 1024 # Number of samples to acquire per block
 samplerate = 48000 # 48000, 44100, 32000, 22100, 16000, 11050, 8000
 
+# Device names contain the model, data format, serial number, sensitivities
+# and calibration date.  Model is one of The Modal Shop model number
+# substrings (_MODELS) followed by two characters, then a separator and the
+# format:
+#   format 1 (acceleration) - 2 x 5 digit sensitivity, 6 digit date
+#   format 2, 3 (voltage)   - 2 x 7 digit sensitivity, 6 digit date
+_MODELS = ("485B", "333D", "633A", "SDC0")
+# _parse_name.pyx mirrors this pattern, keep the two in step.  re.ASCII so
+# \d only matches 0-9 like the compiled version.
+_NAME_RE = re.compile(r'(?P<model>(?:' + '|'.join(_MODELS) + r')..).'
+                      r'(?P<fmt>[123])(?P<sn>\d{6})(?P<rest>\d+)', re.ASCII)
+
+# Convert a YYMMDD calibration date to a datetime.  Faster than strptime
+# and the same date string repeats for each host API listing a device.
+@functools.lru_cache(maxsize=64)
+def _parse_date(yymmdd):
+    return datetime.datetime(2000 + int(yymmdd[0:2]), int(yymmdd[2:4]),
+                             int(yymmdd[4:6]))
+
+# Parse the device details from the part of a device name starting with the
+# model number.  PortAudio lists each device once per host API, so results
+# are memoised and returned as an immutable tuple:
+#   (model, serial_number, format, sensitivity_int, full_scale, date_raw)
+# or None if the name isn't a TMS device.  The device scale is
+# full_scale / sensitivity_int.
+@functools.lru_cache(maxsize=64)
+def _parse_name(name_tail):
+    m = _NAME_RE.match(name_tail)
+    if not m:
+        return None
+    model = m.group('model')        # Extract the model
+    fmt = m.group('fmt')            # Extract the format of data
+    serialnum = m.group('sn')       # Extract the serial number
+    rest = m.group('rest')          # Sensitivities and date
+    # parse devices that are voltage
+    if fmt == "2" or fmt == '3':
+        form = 1    # Voltage
+        # Extract the sensitivity
+        sens = (int(rest[0:7]), int(rest[7:14]))
+        if fmt == "3":  # 50mV reference for format 3
+            sens = (sens[0]*20, sens[1]*20) # Convert to 1V reference
+        full_scale = 8388608.0 # scale to volts
+        date_raw = rest[14:20] # Isolate the calibration date from the fullname string
+    else:
+        # These devices are acceleration
+        form = 0
+        # Extract the sensitivity
+        sens = (int(rest[0:5]), int(rest[5:10]))
+        full_scale = 855400.0 # scale to g's
+        date_raw = rest[10:16] # Isolate the calibration date from the fullname string
+    return (model, serialnum, form, sens, full_scale, date_raw)
+
+# Use the compiled version of _parse_name (_parse_name.pyx) when it is
+# available.  An extension already built with "cythonize -i _parse_name.pyx"
+# is used directly, otherwise pyximport builds it when Cython is installed.
+# If that build fails (no C compiler) the Python version above is used.
+try:
+    import _parse_name as _parse_name_pyx
+except ImportError:
+    try:
+        import pyximport
+    except ImportError:
+        _parse_name_pyx = None     # no Cython
+    else:
+        importers = pyximport.install(language_level=3)
+        try:
+            import _parse_name as _parse_name_pyx
+        except ModuleNotFoundError:
+            _parse_name_pyx = None     # _parse_name.pyx not present
+        except ImportError as e:
+            _parse_name_pyx = None
+            warnings.warn(f"Could not build _parse_name.pyx ({e}), using the "
+                          "Python version.  Build it once with "
+                          "'cythonize -i _parse_name.pyx' or uninstall Cython "
+                          "to skip this build.")
+        finally:
+            pyximport.uninstall(*importers)
+if _parse_name_pyx is not None:
+    _parse_name = functools.lru_cache(maxsize=64)(_parse_name_pyx._parse_name)
+
+# Device information returned by TMSFindDevices.  Behaves like a dict, but
+# "date" holds the raw YYMMDD string until it is first read, when it is
+# converted to a datetime.
+class _DeviceInfo(collections.abc.MutableMapping):
+    def __init__(self, fields):
+        self._data = dict(fields)
+        self._unparsed = "date" in self._data
+
+    def __getitem__(self, key):
+        if key == "date" and self._unparsed:
+            self._data["date"] = _parse_date(self._data["date"])
+            self._unparsed = False
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        if key == "date":
+            self._unparsed = False
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        if key == "date":
+            self._unparsed = False
+        del self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        new = _DeviceInfo(self._data)
+        new._unparsed = self._unparsed
+        return new
+
+# Windows has a variety of API's to access audio
+# many of them manipulate the data and do not support setting actual
+# requested sample rates.  Windows Kernal Streaming allows direct control
+# so find devices using that API
+def _find_wdmks_api():
+    return next((i for i, api in enumerate(sd.query_hostapis())
+                 if api['name'] == "Windows WDM-KS"), 0)
+
+# Host API used to find devices, this doesn't change so look it up once.
+# Not Windows - other platforms don't have the issue with the API
+_IS_WIN = platform == "win32"
+_WDMKS_API = _find_wdmks_api() if _IS_WIN else 0
+
+# Device enumeration can be slow (especially Windows WDM-KS) so the parsed
+# device list is cached.  PortAudio only reads its device table when it is
+# initialized, so the list can't change while the script runs.  Devices
+# plugged in after starting are not found (hotplug is not supported).
+_DEV_CACHE = None
+
+# Return the device numbers and names of the devices on host API api_num.
+# Reads the PortAudio device table directly and only decodes the names of
+# devices on that API, rather than building the full sd.query_devices() list.
+def _query_device_names(api_num):
+    dev_nums = []
+    names = []
+    for dev_num in range(sd._lib.Pa_GetDeviceCount()):
+        info = sd._lib.Pa_GetDeviceInfo(dev_num)
+        if info.hostApi == api_num:
+            dev_nums.append(dev_num)
+            names.append(sd._ffi.string(info.name).decode('utf-8', 'replace'))
+    return dev_nums, names
+
+# Return a copy of the device list so callers can modify "scale" etc.
+# without changing the cached values
+def _copy_dev_info(dev_info):
+    copies = []
+    for d in dev_info:
+        d = d.copy()
+        d['scale'] = d['scale'].copy()
+        d['sensitivity_int'] = d['sensitivity_int'].copy()
+        copies.append(d)
+    return copies
+
 # TMSFindDevices
 #
 # returns an array of TMS compatible devices with associated information
@@ -38,88 +212,137 @@ samplerate = 48000 # 48000, 44100, 32000, 22100, 16000, 11050, 8000
 #   "date"          - Calibration date
 #   "format"        - format of data from device, 0 - acceleration, 1 - voltage
 #   "sensitivity_int - Raw sensitivity as integer counts/EU ie Volta or m/s^2
+#                     ('int32' array)
 #   "scale"         - sensitiivty scaled to float for use with a
 #                     -1.0 to 1.0 scaled data.  Format returned with
 #                     'float32' format to SoundDevice stream.
 def TMSFindDevices():
-    # The Modal Shop model number substrings
-    models=["485B", "333D", "633A", "SDC0"]
-    
-    # Windows has a variety of API's to access audio
-    # many of them manipulate the data and do not support setting actual
-    # requested sample rates.  Windows Kernal Streaming allows direct control
-    # so find devices using that API
-    if platform == "win32":         # Windows...
-        hapis=sd.query_hostapis()
-        api_num=0
-        for api in hapis:
-            if api['name'] == "Windows WDM-KS":
-                break
-            api_num += 1
-    else:
-        # Not Windows - other platforms don't have the issue with the API
-        api_num=0
-    # Return all available audio inputs
-    devices = sd.query_devices()
+    global _DEV_CACHE
+    # Reuse the previous results, the device table doesn't change
+    if _DEV_CACHE is not None:
+        return _copy_dev_info(_DEV_CACHE)
+
+    # Return the audio devices on the WDM-KS API (Windows) or the default API
+    dev_nums, names = _query_device_names(_WDMKS_API)
     dev_info = []   # Array to store info about each compa
-    dev_num=0
-    # Iterate through available devices and find ones named with a TMS model.
+    # Only devices with a TMS model number in the name need to be parsed.
+    # Filter the names with array operations first.
+    # locs is the position of the first model number in each name, -1 if none
+    name_array = np.array(names, dtype=str)
+    locs = np.full(len(names), -1)
+    for model in _MODELS:
+        loc = np.char.find(name_array, model)
+        first = (loc >= 0) & ((locs < 0) | (loc < locs))
+        locs[first] = loc[first]
+    # Iterate through the matching devices and parse the TMS model details.
     # Note this returns multiple instances of the same device, because there
     # are different audio API's available.
-    for device in devices:
-        if (device['hostapi'] == api_num):
-            name = device['name']
-            match = next((x for x in models if x in name), False)
-            if match != False:
-                loc = name.find(match)
-                model = name[loc:loc+6] # Extract the model
-                fmt = name[loc+7:loc+8] # Extract the format of data
-                serialnum = name[loc+8:loc+14]  # Extract the serial number
-                # parse devices that are voltage
-                if fmt == "2" or fmt == '3':
-                    form = 1    # Voltage
-                    # Extract the sensitivity
-                    sens = [int(name[loc+14:loc+21]), int(name[loc+21:loc+28])]
-                    if fmt == "3":  # 50mV reference for format 3
-                        sens[0] *= 20 # Convert to 1V reference
-                        sens[1] *= 20 
-                    scale = np.array([8388608.0/sens[0],
-                                      8388608.0/sens[1]],
-                                     dtype='float32') # scale to volts
-                    date = datetime.datetime.strptime(name[loc+28:loc+34], '%y%m%d') # Isolate the calibration date from the fullname string
-                elif fmt == "1":
-                    # These devices are acceleration
-                    form = 0
-                    # Extract the sensitivity
-                    sens = [int(name[loc+14:loc+19]), int(name[loc+19:loc+24])]
-                    scale = np.array([855400.0/sens[0],
-                                      855400.0/sens[1]],
-                                      dtype='float32') # scale to g's
-                    date = datetime.datetime.strptime(name[loc+24:loc+30], '%y%m%d') # Isolate the calibration date from the fullname string
-                else:
-                      raise FormatError("Expecting 1, 2, or 3 format")
-                 # Add new device to array   
-                dev_info.append({"device":dev_num,\
-                                 "model":model,\
-                                 "serial_number":serialnum,\
-                                 "date":date,\
-                                 "format":form,\
-                                 "sensitivity_int":sens,\
-                                 "scale":scale,\
-                                 })
-        dev_num += 1
+    for i in np.flatnonzero(locs >= 0):
+        dev_num = dev_nums[i]
+        parsed = _parse_name(names[i][locs[i]:])
+        if parsed:
+            model, serialnum, form, sens, full_scale, date_raw = parsed
+            sens = np.array(sens, dtype=np.int32)
+            scale = (np.float32(full_scale) / sens).astype(np.float32, copy=False)
+             # Add new device to array, "date" is parsed when first used
+            dev_info.append(_DeviceInfo(
+                            {"device":dev_num,\
+                             "model":model,\
+                             "serial_number":serialnum,\
+                             "date":date_raw,\
+                             "format":form,\
+                             "sensitivity_int":sens,\
+                             "scale":scale,\
+                             }))
     if len(dev_info) == 0:
         raise NoDevicesFound("No compatible devices found")
-    return dev_info
+    _DEV_CACHE = dev_info
+    return _copy_dev_info(dev_info)
 
 # sounddevice utilizes a call back from PortAudio to lower latency of
 # processing
 # This is called from a different thread
 # Use queue to send data to main processing thread
+#
+# The data is scaled here into a buffer from the free pool, so the main
+# thread only sees scaled data (indata is only valid during the callback).
+# Queue items are (scaled data, min, max).
 def callback(indata, frames, time, status):
+    global dropped
     if status:
         print(status)
-    q.put(indata[:,:])  # Place data in queue
+    try:
+        buf = free.popleft()
+    except IndexError:
+        dropped += 1
+        return  # no free buffer, drop the block
+    lo, hi = _scale_minmax(indata, scale, buf)
+    # Place data in queue.  If the main thread has fallen behind drop the
+    # oldest block so the queue stays bounded.
+    try:
+        q.put_nowait((buf, lo, hi))
+    except queue.Full:
+        try:
+            free.append(q.get_nowait()[0])
+            dropped += 1
+        except queue.Empty:
+            pass
+        q.put_nowait((buf, lo, hi))
+
+# Scale a block of data into out and return the (min, max) of the scaled
+# data in a single pass.  Compiled with Numba when it is installed,
+# otherwise done with NumPy.
+if numba is not None:
+    @numba.njit(cache=True, fastmath=True, boundscheck=False)
+    def _scale_minmax(data, scale, out):
+        n, c = data.shape
+        lo = hi = data[0, 0] * scale[0]
+        for i in range(n):
+            for j in range(c):
+                v = data[i, j] * scale[j]
+                out[i, j] = v
+                if v < lo:
+                    lo = v
+                if v > hi:
+                    hi = v
+        return lo, hi
+else:
+    def _scale_minmax(data, scale, out):
+        np.multiply(data, scale, out=out)
+        return out.min(), out.max()
+
+# Reduce one channel of scaled data to an interleaved min/max envelope of
+# decimate sample groups, quantized to int16 counts for plotting
+def envelope(ydata, decimate, gain, out):
+    groups = ydata.reshape(-1, decimate)
+    np.rint(groups.min(axis=1) * gain, out=out[0::2], casting='unsafe')
+    np.rint(groups.max(axis=1) * gain, out=out[1::2], casting='unsafe')
+    return out
+
+# Save the plot background (everything except the animated line) whenever
+# the figure is fully drawn, so updates can just blit the line over it
+def on_draw(event):
+    global background
+    background = figure.canvas.copy_from_bbox(ax.bbox)
+
+# Show the updated plot line.  When the backend supports blitting only the
+# line is redrawn over the saved background, otherwise the whole figure.
+def draw_line():
+    if blit:
+        figure.canvas.restore_region(background)
+        ax.draw_artist(line)
+        figure.canvas.blit(ax.bbox)
+    else:
+        figure.canvas.draw_idle()
+    figure.canvas.flush_events()
+
+# Y axis limits for data between lo and hi, a crude autoscale.  Pads by 5%
+# of the range each side, with the range at least min_range so a flat or
+# silent signal still gets usable limits.
+def ylimits(lo, hi):
+    mid = (lo + hi) / 2
+    half = max(hi - lo, min_range) * 0.55
+    return mid - half, mid + half
 
 # Helper function to be used for mS delays
 def time_ms():
@@ -140,16 +363,32 @@ scale=info[dev]['scale']
 if info[dev]['format'] == 1: # voltage data so there may be a sensor sensitivity
     for ch in range(len(scale)):
         if eu_sen[ch] != 0.0:
-            scale[ch] *= 1.0 / (eu_sen[ch]/1000.0)
+            scale[ch] = np.float32(scale[ch] * 1000.0 / eu_sen[ch])
             units[ch] = eu_units[ch]
 elif info[dev]['format'] == 0: # acceleration units
     units = ["g", "g"]
 
 # Use q to get data from callback - call back is in different thread
-q = queue.Queue() 
+q = queue.Queue(maxsize=8)
+dropped = 0     # blocks the callback dropped because the queue was full
+# Pool of scaled data buffers for the callback.  Enough for a full queue
+# plus a full queue's worth being processed by the main thread.
+free = collections.deque(np.empty((blocksize, 2), dtype=np.float32)
+                         for i in range(2*q.maxsize + 1))
 
 # set up for example plot by defining the time axis
-x=np.linspace(0, (blocksize-1)/samplerate, blocksize)
+x = np.arange(blocksize, dtype=np.float32)
+x /= samplerate
+
+# Only a min/max envelope of Ch 1 is plotted.  Each group of decimate samples
+# is reduced to a min and max point, quantized so +/- full scale of the
+# device is +/-32767 counts.  The line's transform scales the counts back
+# to EU so the axis stays in engineering units.
+decimate = 8
+gain = 32767.0 / scale[0]
+x_env = np.repeat(x[::decimate], 2)
+y_env = np.empty(len(x_env), dtype=np.int16)
+min_range = 0.01 * scale[0]     # smallest autoscale range, 1% of full scale
 
 plt.ion() # to run GUI event loop
 figure, ax = plt.subplots()
@@ -157,6 +396,9 @@ plt.title("The Modal Shop "+info[dev]['model'], fontsize=20)
 plt.xlabel("Time (S)")
 plt.ylabel(units[0])    # default to Ch 1
 plt.axis([0, (blocksize-1)/samplerate, 0, 20])
+blit = figure.canvas.supports_blit
+if blit:
+    figure.canvas.mpl_connect('draw_event', on_draw)
 first=0
 
 stream = sd.InputStream(
@@ -164,33 +406,60 @@ stream = sd.InputStream(
         samplerate=samplerate, dtype='float32', blocksize=blocksize,
         callback=callback)
 
+# compile before streaming starts
+_scale_minmax(np.zeros((blocksize, 2), dtype=np.float32), scale, free[0])
+
 stream.start()
-# Run for 200 blocks as an example
-for i in range(200):
-    data = q.get()
-    # Note: data *= scale and using 'data' directly in the plot doesn't
-    # always scale correctly.  Sometimes accesses unscaled data.
-    sdata = data * scale # Scale the data by an array multiplication
-
-    # sdata is scaled to engineering units (EU) and ready for processing
-    # appropriate for your specific application
-
-    # Plot data just for an example
-    plt.axis([0, (blocksize-1)/samplerate,
-          np.min(sdata)*1.10, np.max(sdata)*1.10]) # crude autoscale
+# Run for 200 acquired blocks as an example, including any dropped because
+# the main thread fell behind
+blocks = 0
+while blocks + dropped < 200:
+    # Wait for a block, then take any others that queued up while plotting.
+    # Each block in pending is (sdata, lo, hi).  sdata is scaled to
+    # engineering units (EU) and ready for processing appropriate for your
+    # specific application, lo and hi are its range.  Process every block
+    # here before the buffers are returned to the pool below.
+    pending = [q.get()]
+    while True:
+        try:
+            pending.append(q.get_nowait())
+        except queue.Empty:
+            break
+    blocks += len(pending)
+
+    # Plot data just for an example, only the latest block is shown
+    sdata, lo, hi = pending[-1]
     if first == 0:
-        line, = plt.plot(x, sdata[:,0])
+        line, = plt.plot(x_env, envelope(sdata[:,0], decimate, gain, y_env),
+                         animated=blit,
+                         transform=Affine2D().scale(1, 1/gain) + ax.transData)
+        plt.axis([0, (blocksize-1)/samplerate, *ylimits(lo, hi)])
+        if blit:
+            # Saves the background, the animated line is drawn by draw_line
+            figure.canvas.draw()
+        draw_line()
         start = time_ms()
         first = 1
     else:
         # reduce jittery display by only ploting every 100mS
         if time_ms() >= start+100:
             start += 100
-            line.set_xdata(x)
-            line.set_ydata(sdata[:,0])
-            figure.canvas.draw()
-            figure.canvas.flush_events()
+            line.set_ydata(envelope(sdata[:,0], decimate, gain, y_env))
+            # crude autoscale.  New limits need a full redraw, so only
+            # change them when the data leaves the axis or uses less than
+            # half of it.
+            ylo, yhi = ax.get_ylim()
+            if lo < ylo or hi > yhi or max(hi-lo, min_range)*2 < yhi-ylo:
+                ax.set_ylim(*ylimits(lo, hi))
+                if blit:
+                    figure.canvas.draw()
+            draw_line()
+
+    # Return the buffers to the pool for the callback to reuse
+    free.extend(block[0] for block in pending)
 
 # Stop the audio stream
 stream.stop()
+if dropped:
+    print(f"{dropped} blocks dropped, processing fell behind")
 
@@ -0,0 +1,73 @@
+# cython: language_level=3
+#
+# Compiled version of _parse_name from TMS_Digital_Audio.py
+#
+# TMS_Digital_Audio.py uses this through pyximport when Cython is installed
+# and falls back to its own regular expression version otherwise.  Both
+# must return the same results.  This mirrors _NAME_RE, compiled with
+# re.ASCII and no other flags and matched at the start of the name:
+#   (?P<model>(?:485B|333D|633A|SDC0)..).(?P<fmt>[123])(?P<sn>\d{6})(?P<rest>\d+)
+# so '.' is any character except newline and \d is only ASCII 0-9.
+#
+# Parse the device details from the part of a device name starting with the
+# model number.  Returns an immutable tuple:
+#   (model, serial_number, format, sensitivity_int, full_scale, date_raw)
+# or None if the name isn't a TMS device.  The device scale is
+# full_scale / sensitivity_int.
+
+cdef tuple _MODELS = ("485B", "333D", "633A", "SDC0")
+
+cdef inline bint _isdigit(Py_UCS4 c):
+    return u'0' <= c <= u'9'
+
+cpdef tuple _parse_name(str name):
+    cdef Py_ssize_t n = len(name)
+    cdef Py_ssize_t i, end
+    cdef Py_UCS4 fmt
+    cdef int sens[2]
+    cdef str model, serialnum, rest, date_raw
+    cdef int form
+    cdef double full_scale
+
+    # Model number, two characters, a separator, format and 6 digit serial
+    # number followed by the sensitivity and date digits
+    if n < 15 or name[0:4] not in _MODELS:
+        return None
+    for i in range(4, 7):
+        if name[i] == u'\n':
+            return None
+    fmt = name[7]
+    if fmt != u'1' and fmt != u'2' and fmt != u'3':
+        return None
+    for i in range(8, 14):
+        if not _isdigit(name[i]):
+            return None
+    end = 14
+    while end < n and _isdigit(name[end]):
+        end += 1
+    if end == 14:
+        return None
+
+    model = name[0:6]               # Extract the model
+    serialnum = name[8:14]          # Extract the serial number
+    rest = name[14:end]             # Sensitivities and date
+    # parse devices that are voltage
+    if fmt == u'2' or fmt == u'3':
+        form = 1    # Voltage
+        # Extract the sensitivity
+        sens[0] = int(rest[0:7])
+        sens[1] = int(rest[7:14])
+        if fmt == u'3':  # 50mV reference for format 3
+            sens[0] *= 20 # Convert to 1V reference
+            sens[1] *= 20
+        full_scale = 8388608.0 # scale to volts
+        date_raw = rest[14:20] # Isolate the calibration date from the fullname string
+    else:
+        # These devices are acceleration
+        form = 0
+        # Extract the sensitivity
+        sens[0] = int(rest[0:5])
+        sens[1] = int(rest[5:10])
+        full_scale = 855400.0 # scale to g's
+        date_raw = rest[10:16] # Isolate the calibration date from the fullname string
+    return (model, serialnum, form, (sens[0], sens[1]), full_scale, date_raw)